@@ -0,0 +1,229 @@
+"""Time-bucketed vote analytics.
+
+Every vote adds to ``VoteRollup`` rows for its hour and day, once for the
+whole gallery, once for the artwork's location and once for the artwork
+itself. A vote reset takes the deleted votes back out of the buckets they were
+cast in and counts them as removed in the reset's own buckets, so the rollups
+always describe the votes that are still standing. Location rollups count an
+artwork's votes under its current location: moving an artwork moves its
+counts with it. The rows are updated with
+an atomic upsert in the same transaction as the vote, so the superuser
+dashboard reads a fixed number of rollup rows per chart and never has to scan
+the ``vote`` table.
+
+``compact()`` is the periodic maintenance job: it rebuilds the closed hour
+buckets still inside ``HOUR_RETENTION`` from the ``vote`` and
+``vote_reset_log`` rows, re-derives the closed day buckets from those hours
+and drops older hour rows. Votes cast before votes were timestamped keep a
+NULL ``created_at`` and are left out of the time series.
+"""
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+from extensions import db
+from models import Artwork, Vote, VoteResetLog, VoteRollup
+
+HOUR_RETENTION = timedelta(days=7)
+WINDOWS = {'hour': 48, 'day': 30}    # buckets shown on the dashboard
+BATCH_SIZE = 1000
+BUCKET_KEY = ('granularity', 'scope', 'key', 'bucket_start')
+
+
+def bucket_start(timestamp, granularity):
+    if granularity == 'hour':
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _step(granularity):
+    return timedelta(hours=1) if granularity == 'hour' else timedelta(days=1)
+
+
+def _dimensions(artwork_id, location):
+    return [('all', 'all'), ('location', location or 'none'), ('artwork', str(artwork_id))]
+
+
+def _count(counts, granularities, artwork_id, location, timestamp, upvotes=0, downvotes=0, removed=0):
+    """Add one event to ``{(granularity, scope, key, bucket_start): [up, down, removed]}``."""
+    for granularity in granularities:
+        start = bucket_start(timestamp, granularity)
+        for scope, key in _dimensions(artwork_id, location):
+            bucket = counts[(granularity, scope, key, start)]
+            bucket[0] += upvotes
+            bucket[1] += downvotes
+            bucket[2] += removed
+
+
+def _upsert(counts):
+    """Add ``counts`` to the rollup rows in SQL, creating missing rows (no commit).
+
+    The increment happens inside the ``INSERT ... ON CONFLICT DO UPDATE``, so
+    concurrent votes on the same bucket never overwrite each other.
+    """
+    insert = postgresql.insert if db.session.get_bind().dialect.name == 'postgresql' else sqlite.insert
+    rows = [dict(zip(BUCKET_KEY, bucket), upvotes=up, downvotes=down, removed=removed)
+            for bucket, (up, down, removed) in sorted(counts.items())]
+    # Sorted, so concurrent transactions lock the rows in the same order.
+    for start in range(0, len(rows), BATCH_SIZE):
+        stmt = insert(VoteRollup).values(rows[start:start + BATCH_SIZE])
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=list(BUCKET_KEY),
+            set_={'upvotes': VoteRollup.upvotes + stmt.excluded.upvotes,
+                  'downvotes': VoteRollup.downvotes + stmt.excluded.downvotes,
+                  'removed': VoteRollup.removed + stmt.excluded.removed}
+        ))
+
+
+def record_vote(artwork, vote):
+    """Count a newly added vote; call before committing the vote."""
+    vote.created_at = vote.created_at or datetime.utcnow()
+    counts = defaultdict(lambda: [0, 0, 0])
+    _count(counts, WINDOWS, artwork.id, artwork.location, vote.created_at,
+           upvotes=1 if vote.value > 0 else 0,
+           downvotes=1 if vote.value < 0 else 0)
+    _upsert(counts)
+
+
+def record_reset(artwork, timestamp):
+    """Withdraw an artwork's votes from the rollups; call before deleting them.
+
+    Each timestamped vote is subtracted from the buckets it was cast in, and
+    every vote is counted as removed in the reset's buckets. A vote cast
+    between this call and the delete is corrected by the next ``compact()``.
+    """
+    counts = defaultdict(lambda: [0, 0, 0])
+    removed = 0
+    votes = db.session.query(Vote.created_at, Vote.value).filter(Vote.artwork_id == artwork.id)
+    for created_at, value in votes.yield_per(BATCH_SIZE):
+        removed += 1
+        if created_at is not None:
+            _count(counts, WINDOWS, artwork.id, artwork.location, created_at,
+                   upvotes=-1 if value > 0 else 0,
+                   downvotes=-1 if value < 0 else 0)
+    if removed:
+        _count(counts, WINDOWS, artwork.id, artwork.location, timestamp, removed=removed)
+        _upsert(counts)
+
+
+def record_relocation(artwork, old_location):
+    """Move an artwork's counts to its new location; call before committing the change.
+
+    The artwork's own rollup rows hold exactly what it contributed to its
+    location's rows, so they are subtracted from the old location's buckets
+    and added to the new one's.
+    """
+    old_key, new_key = old_location or 'none', artwork.location or 'none'
+    if old_key == new_key:
+        return
+    counts = defaultdict(lambda: [0, 0, 0])
+    rows = VoteRollup.query.filter_by(scope='artwork', key=str(artwork.id))
+    for row in rows.yield_per(BATCH_SIZE):
+        for key, sign in ((old_key, -1), (new_key, 1)):
+            bucket = counts[(row.granularity, 'location', key, row.bucket_start)]
+            bucket[0] += sign * row.upvotes
+            bucket[1] += sign * row.downvotes
+            bucket[2] += sign * row.removed
+    _upsert(counts)
+
+
+def series(granularity, scope='all', key='all', now=None):
+    """Dense list of ``(bucket_start, upvotes, downvotes, removed)`` for the dashboard.
+
+    Reads at most ``WINDOWS[granularity]`` rollup rows, whatever the vote volume.
+    """
+    now = now or datetime.utcnow()
+    step = _step(granularity)
+    last = bucket_start(now, granularity)
+    first = last - step * (WINDOWS[granularity] - 1)
+    rows = VoteRollup.query.filter(
+        VoteRollup.granularity == granularity,
+        VoteRollup.scope == scope,
+        VoteRollup.key == key,
+        VoteRollup.bucket_start >= first,
+        VoteRollup.bucket_start <= last
+    ).all()
+    by_start = {row.bucket_start: row for row in rows}
+    points = []
+    for i in range(WINDOWS[granularity]):
+        start = first + step * i
+        row = by_start.get(start)
+        points.append((start, row.upvotes, row.downvotes, row.removed) if row else (start, 0, 0, 0))
+    return points
+
+
+def _replace(granularity, counts, first, end):
+    """Make the ``granularity`` rows in ``[first, end)`` equal ``counts``. Returns rows changed."""
+    rows = VoteRollup.query.filter(
+        VoteRollup.granularity == granularity,
+        VoteRollup.bucket_start >= first,
+        VoteRollup.bucket_start < end
+    ).all()
+    changed = 0
+    for row in rows:
+        expected = counts.pop((granularity, row.scope, row.key, row.bucket_start), None)
+        if expected is None or not any(expected):
+            if row.upvotes or row.downvotes or row.removed:
+                changed += 1
+            db.session.delete(row)
+        elif [row.upvotes, row.downvotes, row.removed] != expected:
+            row.upvotes, row.downvotes, row.removed = expected
+            changed += 1
+    for (_, scope, key, start), (upvotes, downvotes, removed) in counts.items():
+        if upvotes or downvotes or removed:
+            db.session.add(VoteRollup(granularity=granularity, scope=scope, key=key, bucket_start=start,
+                                      upvotes=upvotes, downvotes=downvotes, removed=removed))
+            changed += 1
+    return changed
+
+
+def compact(now=None):
+    """Reconcile and trim the rollup tables. Returns a dict of counts.
+
+    Only closed buckets are rewritten: the current hour and day are still
+    receiving upserts from live votes and are left to the next run.
+    """
+    now = now or datetime.utcnow()
+    first_hour = bucket_start(now - HOUR_RETENTION, 'hour')
+    current_hour = bucket_start(now, 'hour')
+    # The first day fully covered by retained hours, up to yesterday.
+    first_day = bucket_start(first_hour - timedelta(microseconds=1), 'day') + timedelta(days=1)
+    today = bucket_start(now, 'day')
+
+    # Closed hour buckets are rebuilt from the votes and resets themselves.
+    hours = defaultdict(lambda: [0, 0, 0])
+    votes = (db.session.query(Vote.created_at, Vote.value, Artwork.id, Artwork.location)
+             .join(Artwork, Vote.artwork_id == Artwork.id)
+             .filter(Vote.created_at >= first_hour, Vote.created_at < current_hour))
+    for created_at, value, artwork_id, location in votes.yield_per(BATCH_SIZE):
+        _count(hours, ['hour'], artwork_id, location, created_at,
+               upvotes=1 if value > 0 else 0, downvotes=1 if value < 0 else 0)
+    resets = (db.session.query(VoteResetLog.reset_date, VoteResetLog.votes_removed, Artwork.id, Artwork.location)
+              .join(Artwork, VoteResetLog.artwork_id == Artwork.id)
+              .filter(VoteResetLog.reset_date >= first_hour, VoteResetLog.reset_date < current_hour,
+                      VoteResetLog.votes_removed > 0))
+    for reset_date, removed, artwork_id, location in resets.yield_per(BATCH_SIZE):
+        _count(hours, ['hour'], artwork_id, location, reset_date, removed=removed)
+
+    # Closed day buckets are the sums of their hours.
+    days = defaultdict(lambda: [0, 0, 0])
+    for (_, scope, key, start), (upvotes, downvotes, removed) in hours.items():
+        if first_day <= start < today:
+            bucket = days[('day', scope, key, bucket_start(start, 'day'))]
+            bucket[0] += upvotes
+            bucket[1] += downvotes
+            bucket[2] += removed
+
+    stats = {
+        'hours_fixed': _replace('hour', hours, first_hour, current_hour),
+        'days_fixed': _replace('day', days, first_day, today),
+    }
+
+    # Hour rows older than the retention window are only kept as days.
+    stats['hours_dropped'] = VoteRollup.query.filter(
+        VoteRollup.granularity == 'hour',
+        VoteRollup.bucket_start < first_hour
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return stats
@@ -1,13 +1,26 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, Response, make_response
+from flask import Flask, render_template, request, redirect, url_for, flash, session, Response, make_response, send_file, abort
 from extensions import db  # Import the db instance from extensions.py
 import os
 import qrcode
 from datetime import datetime
 from werkzeug.utils import secure_filename
 from models import User, Artwork, Vote, VoteResetLog, TransactionLog
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
 from PIL import Image
 from flask_mail import Mail, Message
 from itsdangerous import URLSafeTimedSerializer, SignatureExpired, BadSignature
+import click
+import numpy as np
+import palette
+import derivatives
+import assets
+import pixelstore
+import dbutil
+import analytics
+import coldstore
+import re
+import zlib
 
 app = Flask(__name__)
 
@@ -25,7 +38,12 @@ else:
 db.init_app(app)  # Initialize the database with the app
 UPLOAD_FOLDER = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'static', 'uploads')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# 'png' stores uploads as PNG; 'vpx' stores 64x64 artworks in the compact VPX1 format.
+app.config.setdefault('PIXEL_STORAGE', 'png')
+app.config.setdefault('COLD_STORE_FOLDER', os.path.join(os.path.abspath(os.path.dirname(__file__)), 'coldstore'))
+app.config['DERIVATIVE_FOLDER'] = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'static', 'derivatives')
 mail = Mail(app)
+assets.init_app(app)
 s = URLSafeTimedSerializer(app.secret_key)
 
 # Email configuration
@@ -91,6 +109,33 @@ def transaction_logs():
 
 
 
+@app.route('/vote_analytics')
+def vote_analytics():
+    # Only allow superusers to view vote analytics
+    user = User.query.get(session.get('user_id'))
+    if not user or not user.is_superuser:
+        flash("You are not authorized to view vote analytics.", "danger")
+        return redirect(url_for('home'))
+
+    location = request.args.get('location')
+    artwork_id = request.args.get('artwork_id', type=int)
+    if artwork_id:
+        scope, key = 'artwork', str(artwork_id)
+    elif location:
+        scope, key = 'location', location
+    else:
+        scope, key = 'all', 'all'
+
+    charts = []
+    for title, granularity, label in [('Last 48 hours', 'hour', '%d %b %H:00'), ('Last 30 days', 'day', '%d %b')]:
+        points = analytics.series(granularity, scope, key)
+        peak = max(max(up + down + removed for _, up, down, removed in points), 1)
+        charts.append((title, points, label, peak))
+    resets = VoteResetLog.query.order_by(VoteResetLog.reset_date.desc()).limit(20).all()
+    return render_template('vote_analytics.html', charts=charts, resets=resets,
+                           location=location, artwork_id=artwork_id)
+
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
@@ -294,10 +339,13 @@ def upload_artwork():
         # Get the binary data from the image.
         # You can choose to save it as PNG or another format.
         from io import BytesIO
-        img_io = BytesIO()
-        image.save(img_io, format='PNG')
-        img_io.seek(0)
-        binary_data = img_io.read()
+        if app.config['PIXEL_STORAGE'] == 'vpx' and image.size == (pixelstore.SIDE, pixelstore.SIDE):
+            binary_data = pixelstore.encode(np.asarray(image))
+        else:
+            img_io = BytesIO()
+            image.save(img_io, format='PNG')
+            img_io.seek(0)
+            binary_data = img_io.read()
 
         # Create a new Artwork record and store the binary data.
         # (Optionally, you can still store the filename in image_file if needed)
@@ -314,6 +362,12 @@ def upload_artwork():
         db.session.add(new_artwork)
         db.session.commit()
 
+        # Extract the colour palette so the artwork shows up in colour searches.
+        palette.store_palette(new_artwork)
+        # Render the upscaled display variants off the request thread.
+        derivatives.schedule(derivatives.generate_artwork_variants,
+                             app.config['DERIVATIVE_FOLDER'], new_artwork.id, binary_data)
+
         log_event("Artwork Uploaded", f"Artwork '{name}' uploaded by user ID {session['user_id']}.")
         flash("Artwork uploaded successfully!", "success")
         return redirect(url_for('home'))
@@ -324,14 +378,82 @@ def upload_artwork():
 @app.route('/artwork_image/<int:artwork_id>')
 def artwork_image(artwork_id):
     artwork = Artwork.query.get_or_404(artwork_id)
-    if artwork.pixel_data:
-        # Here, 'image/png' is used since we saved the image in PNG format.
-        return Response(artwork.pixel_data, mimetype='image/png')
+    # Archived artworks are read from cold storage without rehydrating them.
+    blob = coldstore.pixel_data(app.config['COLD_STORE_FOLDER'], artwork)
+    if blob:
+        # Artworks kept in the compact VPX1 format are converted back to PNG.
+        return Response(pixelstore.to_png(blob), mimetype='image/png')
     else:
         # Return a default image or a 404 response if no image data is available.
         return Response("No image data found", status=404)
 
 
+@app.route('/artwork_image/<int:artwork_id>/x<int:scale>.<fmt>')
+def artwork_variant(artwork_id, scale, fmt):
+    if scale not in derivatives.ARTWORK_SCALES or fmt not in derivatives.ARTWORK_FORMATS:
+        abort(404)
+    root = app.config['DERIVATIVE_FOLDER']
+    path = derivatives.artwork_variant_path(root, artwork_id, scale, fmt)
+    if os.path.exists(path):
+        return send_file(path, mimetype=derivatives.MIMETYPES[fmt], max_age=86400)
+
+    # Variant not written yet: render it now and queue the full set for writing.
+    artwork = Artwork.query.get_or_404(artwork_id)
+    blob = coldstore.pixel_data(app.config['COLD_STORE_FOLDER'], artwork)
+    if not blob:
+        return Response("No image data found", status=404)
+    # Scales the size cap folds into another variant are redirected to it, and
+    # artworks too large to upscale to the original image.
+    size = pixelstore.image_size(blob[:pixelstore.SIZE_HEADER_BYTES])
+    canonical = derivatives.canonical_scale(*size, scale) if size else None
+    if canonical is None:
+        return redirect(url_for('artwork_image', artwork_id=artwork_id))
+    if canonical != scale:
+        return redirect(url_for('artwork_variant', artwork_id=artwork_id, scale=canonical, fmt=fmt))
+    data = derivatives.cached_render(
+        path,
+        lambda: derivatives.render_artwork(blob, scale, fmt),
+        (derivatives.generate_artwork_variants, root, artwork_id, blob)
+    )
+    return Response(data, mimetype=derivatives.MIMETYPES[fmt])
+
+
+@app.route('/profile_photo/<digest>_<int:size>.<fmt>')
+def profile_photo(digest, size, fmt):
+    if (not re.fullmatch(r'[0-9a-f]{64}', digest) or size not in derivatives.PROFILE_SIZES
+            or fmt not in derivatives.PROFILE_FORMATS):
+        abort(404)
+    root = app.config['DERIVATIVE_FOLDER']
+    path = derivatives.profile_variant_path(root, digest, size, fmt)
+    if not os.path.exists(path):
+        source = derivatives.profile_source_path(root, digest)
+        if not os.path.exists(source):
+            abort(404)
+        with open(source, 'rb') as f:
+            original = f.read()
+        data = derivatives.cached_render(
+            path,
+            lambda: derivatives.render_profile(original, size, fmt),
+            (derivatives.generate_profile_variants, root, digest)
+        )
+        return Response(data, mimetype=derivatives.MIMETYPES[fmt])
+    # Photo variants are named by content hash, so they never change.
+    response = send_file(path, mimetype=derivatives.MIMETYPES[fmt], max_age=31536000)
+    response.cache_control.immutable = True
+    return response
+
+
+@app.template_global()
+def profile_photo_srcset(url):
+    """Build a 1x/2x srcset for a profile photo served by ``profile_photo``."""
+    match = re.search(r'/profile_photo/([0-9a-f]{64})_\d+\.png$', url or '')
+    if not match:
+        return None
+    small, large = derivatives.PROFILE_SIZES
+    return (f"{url_for('profile_photo', digest=match.group(1), size=small, fmt='png')} 1x, "
+            f"{url_for('profile_photo', digest=match.group(1), size=large, fmt='png')} 2x")
+
+
 
 
 @app.route('/my_artworks')
@@ -466,7 +588,15 @@ def vote_artwork(artwork_id, action):
     
     new_vote = Vote(value=vote_value, user_id=user_id, artwork_id=artwork_id)
     db.session.add(new_vote)
-    db.session.commit()
+    try:
+        # The rollups are updated in the same transaction as the vote itself.
+        analytics.record_vote(artwork, new_vote)
+        db.session.commit()
+    except IntegrityError:
+        # A concurrent request from the same user inserted this vote first.
+        db.session.rollback()
+        flash("Your vote could not be recorded. Please try again.", "warning")
+        return redirect(request.referrer or url_for('home'))
     
     flash("Your vote has been recorded.", "success")
     return redirect(request.referrer or url_for('home'))
@@ -494,9 +624,40 @@ def gallery():
     # If a location filter is provided, further filter the artworks
     if location_filter:
         query = query.filter(Artwork.location == location_filter)
-    
-    artworks = query.all()
-    return render_template('gallery.html', artworks=artworks, location_filter=location_filter)
+
+    # Colour filters are answered by the palette index; it returns artwork ids
+    # in ranked order, which is kept when displaying the results.
+    colour_filter = request.args.get('colour')
+    similar_to = request.args.get('similar', type=int)
+    tolerance = request.args.get('tolerance', palette.DEFAULT_TOLERANCE, type=int)
+    ranked_ids = None
+    if colour_filter:
+        rgb = palette.parse_hex_colour(colour_filter)
+        if rgb is None:
+            flash("Colour must be given as #RRGGBB.", "warning")
+        else:
+            ranked_ids = palette.get_index().near_colour(rgb, tolerance)
+    elif similar_to:
+        ranked_ids = palette.get_index().similar(similar_to)
+
+    if ranked_ids is not None:
+        query = query.filter(Artwork.id.in_(ranked_ids))
+
+    # Upscaled variants are listed with their real rendered widths, read from
+    # the stored image header rather than the whole (deferred) blob.
+    headers = query.with_entities(Artwork.id, func.substr(Artwork.pixel_data, 1, pixelstore.SIZE_HEADER_BYTES))
+    variants = {}
+    for artwork_id, header in headers:
+        size = pixelstore.image_size(header)
+        variants[artwork_id] = derivatives.artwork_scales(*size) if size else []
+
+    # Each card shows its dominant colours, so load the palettes with the artworks.
+    artworks = query.options(db.joinedload(Artwork.palette)).all()
+    if ranked_ids is not None:
+        rank = {artwork_id: i for i, artwork_id in enumerate(ranked_ids)}
+        artworks.sort(key=lambda art: rank[art.id])
+    return render_template('gallery.html', artworks=artworks, location_filter=location_filter, variants=variants,
+                           colour_filter=colour_filter, similar_to=similar_to, tolerance=tolerance)
 
 
 
@@ -518,7 +679,10 @@ def archive_artwork(artwork_id):
     artwork.archived = True
     artwork.archived_by = current_user.username  # Record the username
     artwork.archived_date = datetime.utcnow()     # Record the current date/time
+    # Move the image bytes out of the artwork table; votes stay attached to the artwork.
+    coldstore.freeze(app.config['COLD_STORE_FOLDER'], artwork)
     db.session.commit()
+    log_event("Artwork Archived", f"Artwork '{artwork.name}' (ID: {artwork.id}) archived by user '{current_user.username}'.")
     flash("Artwork archived.", "success")
     return redirect(request.referrer or url_for('home'))
 
@@ -539,7 +703,16 @@ def unarchive_artwork(artwork_id):
     artwork.archived = False
     artwork.archived_by = None
     artwork.archived_date = None
+    try:
+        coldstore.thaw(app.config['COLD_STORE_FOLDER'], artwork)
+    except (IOError, zlib.error) as e:
+        db.session.rollback()
+        flash("Could not restore the artwork image: " + str(e), "danger")
+        return redirect(request.referrer or url_for('home'))
     db.session.commit()
+    log_event("Artwork Unarchived", f"Artwork '{artwork.name}' (ID: {artwork.id}) unarchived by user '{current_user.username}'.")
+    # The restored record is now dead space in its segment.
+    coldstore.schedule_compaction(app, app.config['COLD_STORE_FOLDER'])
     flash("Artwork unarchived.", "success")
     return redirect(request.referrer or url_for('home'))
 
@@ -584,16 +757,14 @@ def profile():
         if 'profile_photo' in request.files:
             photo = request.files['profile_photo']
             if photo and photo.filename != '':
-                filename = secure_filename(photo.filename)
                 try:
-                    image = Image.open(photo)
-                    # Resize image to 90x90 px
-                    image = image.resize((90, 90))
-                    photo_folder = os.path.join(app.root_path, 'static', 'profile_photos')
-                    os.makedirs(photo_folder, exist_ok=True)
-                    file_path = os.path.join(photo_folder, filename)
-                    image.save(file_path, format='PNG')
-                    user.profile_photo_url = url_for('static', filename='profile_photos/' + filename)
+                    # Store the original under its content hash; the 90x90 and
+                    # 180x180 variants are rendered in the background.
+                    root = app.config['DERIVATIVE_FOLDER']
+                    digest = derivatives.store_profile_source(root, photo.read())
+                    derivatives.schedule(derivatives.generate_profile_variants, root, digest)
+                    user.profile_photo_url = url_for('profile_photo', digest=digest,
+                                                     size=derivatives.PROFILE_SIZES[0], fmt='png')
                 except Exception as e:
                     flash("Error processing profile photo: " + str(e), "danger")
                     return redirect(url_for('profile'))
@@ -626,11 +797,13 @@ def reset_votes(artwork_id):
         flash("Please provide a reason for resetting votes.", "warning")
         return redirect(url_for('moderate_artworks'))
     
-    # Reset votes: delete all votes for this artwork.
-    Vote.query.filter_by(artwork_id=artwork.id).delete()
+    # Take the votes out of the rollups, then delete all votes for this artwork.
+    reset_date = datetime.utcnow()
+    analytics.record_reset(artwork, reset_date)
+    removed = Vote.query.filter_by(artwork_id=artwork.id).delete()
     
     # Log the vote reset event.
-    new_log = VoteResetLog(artwork_id=artwork.id, reason=reason)
+    new_log = VoteResetLog(artwork_id=artwork.id, reason=reason, reset_date=reset_date, votes_removed=removed)
     db.session.add(new_log)
     db.session.commit()
     
@@ -682,12 +855,132 @@ def assign_location(artwork_id):
         flash("Please select a valid location.", "warning")
         return redirect(url_for('moderate_artworks'))
     
+    old_location = artwork.location
     artwork.location = new_location
+    # The artwork's vote counts move to the new location's rollups.
+    analytics.record_relocation(artwork, old_location)
     db.session.commit()
     flash("Location assigned successfully.", "success")
     return redirect(url_for('moderate_artworks'))
 
 
+@app.cli.command('backfill-palettes')
+@click.option('--batch-size', default=256, help='Artworks decoded per batch.')
+def backfill_palettes_command(batch_size):
+    """Extract colour palettes for artworks uploaded before palette indexing."""
+    written = palette.backfill_palettes(batch_size=batch_size)
+    print(f"Extracted {written} artwork palettes.")
+
+
+@app.cli.command('generate-derivatives')
+@click.option('--batch-size', default=100, help='Artworks loaded per batch.')
+def generate_derivatives_command(batch_size):
+    """Write upscaled display variants for every artwork that lacks them."""
+    root = app.config['DERIVATIVE_FOLDER']
+    count = 0
+    for artwork_id, blob in dbutil.iter_artwork_blobs(batch_size):
+        derivatives.generate_artwork_variants(root, artwork_id, blob)
+        count += 1
+    print(f"Generated variants for {count} artworks.")
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Fingerprint, precompress and resize static assets into static/dist."""
+    manifest = assets.build(app.static_folder)
+    app.extensions['assets'] = manifest
+    print(f"Built {len(manifest['files'])} assets and "
+          f"{sum(len(v) for v in manifest['responsive'].values())} responsive images.")
+
+
+@app.cli.command('asset-report')
+def asset_report_command():
+    """Compare first-visit transfer size with and without built assets."""
+    for path, (before, after) in assets.transfer_report(app).items():
+        print(f"{path}: {before} bytes before, {after} bytes after ({after / before:.0%})")
+
+
+@app.cli.command('convert-pixels')
+@click.argument('storage', type=click.Choice(['png', 'vpx']))
+@click.option('--batch-size', default=500, help='Artworks converted per batch.')
+def convert_pixels_command(storage, batch_size):
+    """Rewrite stored 64x64 artwork pixels as PNG or compact VPX1."""
+    converted, before, after = 0, 0, 0
+    # pixel_data is deferred; load it with each batch instead of one query per artwork.
+    query = Artwork.query.options(db.undefer(Artwork.pixel_data)).filter(Artwork.pixel_data.isnot(None))
+    for artworks in dbutil.keyset_batches(query, Artwork.id, batch_size):
+        for artwork in artworks:
+            blob = artwork.pixel_data
+            if pixelstore.is_vpx(blob) == (storage == 'vpx'):
+                continue
+            try:
+                rgba = pixelstore.load_rgba(blob)
+            except Exception:
+                continue
+            if storage == 'vpx' and rgba.shape != (pixelstore.SIDE, pixelstore.SIDE, 4):
+                continue
+            artwork.pixel_data = pixelstore.encode(rgba) if storage == 'vpx' else pixelstore.to_png(blob)
+            before += len(blob)
+            after += len(artwork.pixel_data)
+            converted += 1
+        db.session.commit()
+        db.session.expunge_all()
+    print(f"Converted {converted} artworks to {storage}: {before} -> {after} bytes.")
+
+
+@app.cli.command('pack-pixels')
+@click.argument('path')
+def pack_pixels_command(path):
+    """Decode every 64x64 artwork into one memory-mappable batch file."""
+    count = pixelstore.pack(path, dbutil.iter_artwork_blobs())
+    print(f"Packed {count} artworks into {path}.")
+
+
+@app.cli.command('compact-vote-rollups')
+def compact_vote_rollups_command():
+    """Reconcile vote rollups and drop expired hourly buckets."""
+    stats = analytics.compact()
+    print(f"Fixed {stats['hours_fixed']} hourly and {stats['days_fixed']} daily buckets "
+          f"and dropped {stats['hours_dropped']} expired hourly buckets.")
+
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Add columns introduced since the first release to an existing database."""
+    added = dbutil.add_missing_columns()
+    print(f"Added {', '.join(added)}." if added else "Database is up to date.")
+
+
+@app.cli.command('cold-store-archived')
+@click.option('--batch-size', default=200, help='Artworks moved per batch.')
+@click.option('--vacuum', is_flag=True, help='VACUUM a SQLite database afterwards to shrink the file.')
+def cold_store_archived_command(batch_size, vacuum):
+    """Move the image bytes of already archived artworks to cold storage."""
+    root = app.config['COLD_STORE_FOLDER']
+    moved = 0
+    query = (Artwork.query.options(db.undefer(Artwork.pixel_data), db.joinedload(Artwork.cold_copy))
+             .filter(Artwork.archived == True, Artwork.pixel_data.isnot(None)))
+    for artworks in dbutil.keyset_batches(query, Artwork.id, batch_size):
+        for artwork in artworks:
+            coldstore.freeze(root, artwork)
+        db.session.commit()
+        db.session.expunge_all()
+        moved += len(artworks)
+    if vacuum and db.engine.dialect.name == 'sqlite':
+        with db.engine.connect() as conn:
+            conn.exec_driver_sql('VACUUM')
+    print(f"Moved {moved} archived artworks to cold storage.")
+
+
+@app.cli.command('compact-cold-store')
+@click.option('--min-age', default=coldstore.COMPACT_MIN_AGE,
+              help='Skip segments appended to within this many seconds.')
+def compact_cold_store_command(min_age):
+    """Reclaim space from cold store segments left mostly dead by unarchiving."""
+    reclaimed = coldstore.compact(app.config['COLD_STORE_FOLDER'], min_age=min_age)
+    print(f"Reclaimed {reclaimed} bytes.")
+
+
 # Initialize database tables
 with app.app_context():
     db.create_all()
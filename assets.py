@@ -0,0 +1,266 @@
+"""Fingerprinted, precompressed static assets.
+
+``build()`` copies the files under ``static/`` into ``static/dist/`` with a
+content hash in their names, writes gzip (and brotli, when the ``brotli``
+package is installed) siblings for text assets, renders resized WebP/AVIF
+versions of the landing-page images and records everything in
+``static/dist/manifest.json``.
+
+``init_app()`` registers the ``/assets/`` route that serves those files with
+``Content-Encoding`` negotiation and immutable caching, and replaces the Jinja
+``url_for`` so that ``url_for('static', filename=...)`` points at the
+fingerprinted copy whenever the manifest has one.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+from html.parser import HTMLParser
+
+from flask import request, send_from_directory, url_for as flask_url_for, abort
+from PIL import Image, features
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always produced
+    brotli = None
+
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+# User-generated and derived content is never fingerprinted.
+SKIP_DIRS = {DIST_DIR, 'derivatives', 'uploads', 'profile_photos', 'qr_codes'}
+COMPRESSIBLE = {'.css', '.js', '.svg', '.json', '.txt', '.html', '.map'}
+MIN_COMPRESS_BYTES = 256
+RESPONSIVE_DIR = 'images'
+RESPONSIVE_MIN_WIDTH = 500
+RESPONSIVE_WIDTHS = (320, 640, 960)
+RESPONSIVE_FORMATS = {'webp': 80, 'avif': 50}
+IMMUTABLE_MAX_AGE = 31536000
+
+
+def _fingerprint(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+def _hashed_name(filename, digest, suffix=''):
+    stem, ext = os.path.splitext(filename)
+    return f"{stem}{suffix}.{digest}{ext}"
+
+
+def _compress(path):
+    """Write ``.gz`` and ``.br`` siblings for ``path``; return their sizes."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    sizes = {}
+    gz = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(gz) < len(data):
+        with open(path + '.gz', 'wb') as f:
+            f.write(gz)
+        sizes['gzip'] = len(gz)
+    if brotli is not None:
+        br = brotli.compress(data, quality=11)
+        if len(br) < len(data):
+            with open(path + '.br', 'wb') as f:
+                f.write(br)
+            sizes['br'] = len(br)
+    return sizes
+
+
+def _responsive_variants(source, filename, dist_root):
+    """Render resized WebP/AVIF copies of a landing-page image."""
+    image = Image.open(source)
+    if image.width < RESPONSIVE_MIN_WIDTH:
+        return []
+    image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+    widths = sorted({w for w in RESPONSIVE_WIDTHS if w < image.width} | {image.width})
+    variants = []
+    for fmt, quality in RESPONSIVE_FORMATS.items():
+        if not features.check(fmt):
+            continue
+        for width in widths:
+            height = round(image.height * width / image.width)
+            resized = image if width == image.width else image.resize((width, height), Image.LANCZOS)
+            stem = os.path.splitext(filename)[0]
+            tmp_path = os.path.join(dist_root, f"{stem}-{width}w.tmp.{fmt}")
+            os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
+            resized.save(tmp_path, format=fmt.upper(), quality=quality)
+            name = _hashed_name(f"{stem}.{fmt}", _fingerprint(tmp_path), suffix=f"-{width}w")
+            os.replace(tmp_path, os.path.join(dist_root, name))
+            variants.append({'format': fmt, 'width': width, 'path': name})
+    return variants
+
+
+def build(static_folder):
+    """Rebuild ``static/dist`` and its manifest from scratch."""
+    dist_root = os.path.join(static_folder, DIST_DIR)
+    shutil.rmtree(dist_root, ignore_errors=True)
+    os.makedirs(dist_root)
+
+    manifest = {'files': {}, 'responsive': {}}
+    for dirpath, dirnames, filenames in os.walk(static_folder):
+        rel_dir = os.path.relpath(dirpath, static_folder)
+        if rel_dir == '.':
+            dirnames[:] = [d for d in dirnames if d not in SKIP_DIRS]
+        for name in filenames:
+            if name.startswith('.'):
+                continue
+            source = os.path.join(dirpath, name)
+            filename = os.path.normpath(os.path.join(rel_dir, name)).replace(os.sep, '/')
+            hashed = _hashed_name(filename, _fingerprint(source))
+            target = os.path.join(dist_root, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(source, target)
+            manifest['files'][filename] = hashed
+
+            if os.path.splitext(name)[1].lower() in COMPRESSIBLE and os.path.getsize(source) >= MIN_COMPRESS_BYTES:
+                _compress(target)
+            if rel_dir == RESPONSIVE_DIR:
+                try:
+                    variants = _responsive_variants(source, filename, dist_root)
+                except OSError:
+                    variants = []
+                if variants:
+                    manifest['responsive'][filename] = variants
+
+    with open(os.path.join(dist_root, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(static_folder):
+    try:
+        with open(os.path.join(static_folder, DIST_DIR, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'files': {}, 'responsive': {}}
+
+
+def init_app(app):
+    """Serve built assets and point ``url_for('static')`` at them."""
+    app.extensions['assets'] = load_manifest(app.static_folder)
+    dist_root = os.path.join(app.static_folder, DIST_DIR)
+
+    def manifest():
+        return app.extensions['assets']
+
+    def asset_url_for(endpoint, **values):
+        if endpoint == 'static':
+            hashed = manifest()['files'].get(values.get('filename'))
+            if hashed:
+                values['filename'] = hashed
+                return flask_url_for('assets', **values)
+        return flask_url_for(endpoint, **values)
+
+    def asset_srcset(filename, fmt):
+        """``srcset`` of the resized ``fmt`` copies of a static image, if built."""
+        variants = [v for v in manifest()['responsive'].get(filename, []) if v['format'] == fmt]
+        return ', '.join(f"{flask_url_for('assets', filename=v['path'])} {v['width']}w" for v in variants)
+
+    @app.route('/assets/<path:filename>')
+    def assets(filename):
+        # Only names the manifest produced are served; precompressed siblings
+        # are picked by negotiation, never requested directly.
+        path = safe_join(dist_root, filename)
+        if path is None or filename.endswith(('.gz', '.br')) or not os.path.isfile(path):
+            abort(404)
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        encoding, served = None, filename
+        for name, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if request.accept_encodings[name] and os.path.isfile(path + suffix):
+                encoding, served = name, filename + suffix
+                break
+
+        response = send_from_directory(dist_root, served, mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        return response
+
+    app.jinja_env.globals['url_for'] = asset_url_for
+    app.jinja_env.globals['asset_srcset'] = asset_srcset
+
+
+class _ResourceParser(HTMLParser):
+    """Collect the same-origin resources a browser would fetch for a page.
+
+    Inside ``<picture>`` only the first ``<source>`` is used, and ``srcset``
+    candidates are resolved for an image slot of ``REPORT_SLOT_WIDTH`` pixels.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.urls = []
+        self._in_picture = False
+        self._picked = False
+
+    def _add(self, url):
+        if url and url.startswith('/') and not url.startswith('//'):
+            self.urls.append(url)
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'picture':
+            self._in_picture, self._picked = True, False
+        elif tag == 'source' and self._in_picture:
+            if not self._picked and attrs.get('srcset'):
+                self._add(_pick_candidate(attrs['srcset']))
+                self._picked = True
+        elif tag == 'img' and not (self._in_picture and self._picked):
+            self._add(_pick_candidate(attrs['srcset']) if attrs.get('srcset') else attrs.get('src'))
+        elif tag in ('script', 'video', 'source'):
+            self._add(attrs.get('src'))
+        elif tag == 'link' and attrs.get('rel') in ('stylesheet', 'icon', 'shortcut icon'):
+            self._add(attrs.get('href'))
+
+    def handle_endtag(self, tag):
+        if tag == 'picture':
+            self._in_picture = False
+
+
+REPORT_SLOT_WIDTH = 640
+
+
+def _pick_candidate(srcset):
+    candidates = []
+    for entry in srcset.split(','):
+        parts = entry.split()
+        if parts:
+            width = int(parts[1][:-1]) if len(parts) > 1 and parts[1].endswith('w') else 0
+            candidates.append((width, parts[0]))
+    wide_enough = [c for c in sorted(candidates) if c[0] >= REPORT_SLOT_WIDTH]
+    return (wide_enough or sorted(candidates))[0 if wide_enough else -1][1]
+
+
+def _page_bytes(client, path, headers):
+    response = client.get(path, headers=headers)
+    total = len(response.get_data())
+    parser = _ResourceParser()
+    parser.feed(response.get_data(as_text=True))
+    for url in dict.fromkeys(parser.urls):
+        total += len(client.get(url, headers=headers).get_data())
+    return total
+
+
+def transfer_report(app, paths=('/', '/gallery')):
+    """First-visit bytes per page, with plain static files and with built assets."""
+    client = app.test_client()
+    built = app.extensions['assets']
+    report = {}
+    try:
+        app.extensions['assets'] = {'files': {}, 'responsive': {}}
+        before = {path: _page_bytes(client, path, {}) for path in paths}
+    finally:
+        app.extensions['assets'] = built
+    accept = {'Accept-Encoding': 'br, gzip' if brotli is not None else 'gzip'}
+    for path in paths:
+        report[path] = (before[path], _page_bytes(client, path, accept))
+    return report
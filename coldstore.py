@@ -0,0 +1,238 @@
+"""Cold storage for the image bytes of archived artworks.
+
+Archiving an artwork appends its ``pixel_data`` to an append-only segment file
+under ``COLD_STORE_FOLDER`` and records where it went in a ``ColdArtwork`` row,
+so the ``artwork`` table no longer carries the blob. Unarchiving reads the
+record back into ``pixel_data`` and drops the index row, which leaves the old
+record behind as dead space. ``compact()`` rewrites the live records of mostly
+dead segments, the active one included, into a fresh segment and deletes them.
+
+Each record is a fixed header followed by the (optionally zlib-compressed)
+bytes::
+
+    magic b'CSR1' | artwork_id u32 | stored_length u32 | raw_length u32 | crc32 u32 | compressed u8
+"""
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # no cross-process locking on Windows
+    fcntl = None
+
+from sqlalchemy import func
+
+from extensions import db
+from models import ColdArtwork
+
+RECORD = struct.Struct('<4sIIIIB')
+MAGIC = b'CSR1'
+SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+COMPACT_DEAD_RATIO = 0.5      # segments at least this dead are rewritten
+# Seconds a segment must go without appends before it is rewritten: freeze()
+# appends under the lock but its index row is only committed by the caller.
+COMPACT_MIN_AGE = 10
+COMPRESSION_LEVEL = 6
+SEGMENT_NAME = re.compile(r'^seg-(\d{6})\.dat$')
+
+_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='coldstore')
+_scheduled = threading.Lock()  # held while a background compaction is queued or running
+
+
+class _StoreLock:
+    """Serialise writers across threads and, where supported, processes."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def __enter__(self):
+        _lock.acquire()
+        os.makedirs(self.root, exist_ok=True)
+        self.file = open(os.path.join(self.root, 'LOCK'), 'a')
+        if fcntl is not None:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+        _lock.release()
+
+
+def segment_path(root, segment):
+    return os.path.join(root, f"seg-{segment:06d}.dat")
+
+
+def segments(root):
+    """Numbers of the segment files on disk, oldest first."""
+    if not os.path.isdir(root):
+        return []
+    return sorted(int(m.group(1)) for m in map(SEGMENT_NAME.match, os.listdir(root)) if m)
+
+
+def _active_segment(root, incoming, first=1):
+    existing = [s for s in segments(root) if s >= first]
+    if not existing:
+        return first
+    last = existing[-1]
+    if os.path.getsize(segment_path(root, last)) + incoming > SEGMENT_MAX_BYTES:
+        return last + 1
+    return last
+
+
+def _append(root, artwork_id, data, first=1):
+    """Append one record and return ``(segment, offset, length)``; caller holds the lock.
+
+    The record goes to the last segment numbered ``first`` or higher, or a
+    new one once that is full.
+    """
+    packed = zlib.compress(data, COMPRESSION_LEVEL)
+    compressed = len(packed) < len(data)
+    if not compressed:
+        packed = data
+    record = RECORD.pack(MAGIC, artwork_id, len(packed), len(data), zlib.crc32(data), compressed) + packed
+    segment = _active_segment(root, len(record), first)
+    with open(segment_path(root, segment), 'ab') as f:
+        offset = f.tell()
+        f.write(record)
+        f.flush()
+        os.fsync(f.fileno())
+    return segment, offset, len(record)
+
+
+def read_record(root, segment, offset, length):
+    """Read and verify one record, returning the original bytes."""
+    with open(segment_path(root, segment), 'rb') as f:
+        f.seek(offset)
+        record = f.read(length)
+    magic, _, stored, raw, crc, compressed = RECORD.unpack_from(record)
+    if magic != MAGIC or len(record) != RECORD.size + stored:
+        raise IOError(f"corrupt cold store record in segment {segment} at offset {offset}")
+    data = record[RECORD.size:]
+    if compressed:
+        data = zlib.decompress(data)
+    if len(data) != raw or zlib.crc32(data) != crc:
+        raise IOError(f"checksum mismatch in segment {segment} at offset {offset}")
+    return data
+
+
+def freeze(root, artwork):
+    """Move an artwork's image bytes to cold storage (no commit)."""
+    if artwork.pixel_data is None or artwork.cold_copy is not None:
+        return
+    with _StoreLock(root):
+        segment, offset, length = _append(root, artwork.id, artwork.pixel_data)
+    artwork.cold_copy = ColdArtwork(segment=segment, offset=offset, length=length)
+    artwork.pixel_data = None
+
+
+def _read_entry(root, entry):
+    try:
+        return read_record(root, entry.segment, entry.offset, entry.length)
+    except FileNotFoundError:
+        # The segment was compacted away after the index row was loaded.
+        db.session.refresh(entry)
+        return read_record(root, entry.segment, entry.offset, entry.length)
+
+
+def thaw(root, artwork):
+    """Bring an artwork's image bytes back into the ``artwork`` row (no commit).
+
+    The record is read under the store lock, so a compaction cannot move it
+    and delete its segment partway through.
+    """
+    entry = artwork.cold_copy
+    if entry is None:
+        return
+    with _StoreLock(root):
+        artwork.pixel_data = _read_entry(root, entry)
+    artwork.cold_copy = None  # delete-orphan removes the index row
+
+
+def pixel_data(root, artwork):
+    """Image bytes for an artwork, whichever tier they are in."""
+    if artwork.pixel_data is not None:
+        return artwork.pixel_data
+    entry = artwork.cold_copy
+    if entry is None:
+        return None
+    return _read_entry(root, entry)
+
+
+def segment_usage(root):
+    """``{segment: (live_bytes, file_bytes)}`` for every segment on disk."""
+    live = dict(db.session.query(ColdArtwork.segment, func.sum(ColdArtwork.length))
+                .group_by(ColdArtwork.segment).all())
+    return {s: (int(live.get(s) or 0), os.path.getsize(segment_path(root, s))) for s in segments(root)}
+
+
+def _mostly_dead(live, size, dead_ratio):
+    return size > 0 and (size - live) / size >= dead_ratio
+
+
+def compact(root, dead_ratio=COMPACT_DEAD_RATIO, min_age=COMPACT_MIN_AGE):
+    """Rewrite mostly-dead segments and delete them. Returns bytes reclaimed.
+
+    Live records are copied to a segment numbered after every existing one,
+    so the active segment can be compacted too, and a segment with no live
+    records is simply deleted. The index is committed before the old file is
+    removed, so a crash at any point leaves every artwork readable; at worst
+    some copied records become dead space. Segments appended to within the
+    last ``min_age`` seconds are left alone.
+    """
+    reclaimed = 0
+    with _StoreLock(root):
+        existing = segments(root)
+        if not existing:
+            return 0
+        usage = segment_usage(root)
+        settled = time.time() - min_age
+        first_new = existing[-1] + 1
+        for segment in existing:
+            live, size = usage[segment]
+            path = segment_path(root, segment)
+            if not _mostly_dead(live, size, dead_ratio) or os.path.getmtime(path) > settled:
+                continue
+            if live:
+                entries = ColdArtwork.query.filter_by(segment=segment).order_by(ColdArtwork.offset).all()
+                for entry in entries:
+                    data = read_record(root, entry.segment, entry.offset, entry.length)
+                    entry.segment, entry.offset, entry.length = _append(root, entry.artwork_id, data, first_new)
+                db.session.commit()
+            os.remove(path)
+            reclaimed += size - live
+        if not segments(root):
+            # Segment numbers are never reused, so a stale index row can only
+            # ever miss its file, not read another record at the same offset.
+            open(segment_path(root, first_new), 'ab').close()
+    return reclaimed
+
+
+def needs_compaction(root, dead_ratio=COMPACT_DEAD_RATIO):
+    return any(_mostly_dead(live, size, dead_ratio) for live, size in segment_usage(root).values())
+
+
+def schedule_compaction(app, root):
+    """Run ``compact()`` on the background worker if any segment is mostly dead.
+
+    At most one compaction is queued at a time. It waits ``COMPACT_MIN_AGE``
+    first so the segment that was just appended to can be rewritten too.
+    """
+    if not needs_compaction(root) or not _scheduled.acquire(blocking=False):
+        return None
+
+    def run():
+        try:
+            time.sleep(COMPACT_MIN_AGE + 1)
+            with app.app_context():
+                compact(root, min_age=COMPACT_MIN_AGE)
+        finally:
+            _scheduled.release()
+    return _executor.submit(run)
@@ -4,6 +4,7 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(BASE_DIR, 'coursework.db')
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 SECRET_KEY = 'yoyoyo'
+PIXEL_STORAGE = 'png'
 
             
    
@@ -2,10 +2,15 @@ from app import app
 from extensions import db
 import models  
 from models import User
+from dbutil import add_missing_columns
 
 with app.app_context():
     db.create_all()
     print("Database tables created!")    
+    # Bring a database from an older version up to date with the models.
+    added = add_missing_columns()
+    if added:
+        print(f"Added columns: {', '.join(added)}")
     if not User.query.filter_by(is_superuser=True).first():
         superuser = User(username="admin", email="admin@gmail.com")
         superuser.set_password("admin")
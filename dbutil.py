@@ -0,0 +1,50 @@
+"""Database helpers shared by the CLI commands and background jobs."""
+from sqlalchemy import inspect
+
+from extensions import db
+from models import Artwork, Vote, VoteResetLog
+
+
+# Columns added after the first release; db.create_all() does not add columns
+# to tables that already exist.
+ADDED_COLUMNS = [Vote.__table__.c.created_at, VoteResetLog.__table__.c.votes_removed]
+
+
+def add_missing_columns():
+    """Add ``ADDED_COLUMNS`` to tables created by older versions. Returns the names added."""
+    engine = db.engine
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    added = []
+    with engine.begin() as conn:
+        for column in ADDED_COLUMNS:
+            existing = {c['name'] for c in inspector.get_columns(column.table.name)}
+            if column.name not in existing:
+                ddl = column.type.compile(dialect=engine.dialect)
+                conn.exec_driver_sql(f"ALTER TABLE {quote(column.table.name)} "
+                                     f"ADD COLUMN {quote(column.name)} {ddl}")
+                added.append(f"{column.table.name}.{column.name}")
+    return added
+
+
+def keyset_batches(query, key, batch_size=500, after=0):
+    """Yield the rows of ``query`` in ``key`` order, ``batch_size`` rows at a time.
+
+    Each batch is fetched with ``key > last key seen`` rather than an offset,
+    so every query stays an index range scan however far the walk has got.
+    The next batch is only fetched once the caller has handled the previous
+    one, so callers may commit and ``expunge_all()`` in between.
+    """
+    while True:
+        rows = query.filter(key > after).order_by(key).limit(batch_size).all()
+        if not rows:
+            return
+        after = getattr(rows[-1], key.key)
+        yield rows
+
+
+def iter_artwork_blobs(batch_size=500):
+    """Yield ``(artwork_id, pixel_data)`` for every artwork with image bytes, in id order."""
+    query = db.session.query(Artwork.id, Artwork.pixel_data).filter(Artwork.pixel_data.isnot(None))
+    for rows in keyset_batches(query, Artwork.id, batch_size):
+        yield from rows
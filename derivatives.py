@@ -0,0 +1,192 @@
+"""Display-size derivatives for artworks and profile photos.
+
+Artworks are upscaled with nearest-neighbour sampling so pixel art stays crisp
+in the browser, and profile photos are resampled with Lanczos. Variants are
+rendered on a background worker and written once under ``DERIVATIVE_FOLDER``.
+A request for a variant that has not been written yet is rendered on the spot,
+kept in a size-capped in-memory cache and queued for writing.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+import pixelstore
+
+ARTWORK_SCALES = (2, 4, 8)
+ARTWORK_FORMATS = ('png', 'webp')
+MAX_ARTWORK_SIDE = 512    # oversized uploads are never upscaled past this
+PROFILE_SIZES = (90, 180)
+PROFILE_FORMATS = ('png', 'webp')
+CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+MIMETYPES = {'png': 'image/png', 'webp': 'image/webp'}
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='derivatives')
+
+
+class ByteCache:
+    """Least-recently-used cache of rendered variants, capped by total bytes."""
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._items[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+
+cache = ByteCache()
+
+
+def _encode(image, fmt):
+    out = BytesIO()
+    if fmt == 'webp':
+        image.save(out, format='WEBP', lossless=True, method=6)
+    else:
+        image.save(out, format='PNG', optimize=True)
+    return out.getvalue()
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def effective_scale(width, height, scale):
+    """The scale ``render_artwork`` actually applies once capped at ``MAX_ARTWORK_SIDE``."""
+    return max(1, min(scale, MAX_ARTWORK_SIDE // max(width, height)))
+
+
+def artwork_scales(width, height):
+    """``[(scale, rendered_width), ...]`` for the scales that produce distinct upscales.
+
+    Scales that the size cap reduces to an already listed size are skipped,
+    and an artwork too large to upscale at all gets an empty list.
+    """
+    scales, seen = [], {1}
+    for scale in ARTWORK_SCALES:
+        applied = effective_scale(width, height, scale)
+        if applied not in seen:
+            seen.add(applied)
+            scales.append((scale, width * applied))
+    return scales
+
+
+def canonical_scale(width, height, scale):
+    """The listed scale that renders the same image as ``scale``, or None if it is not an upscale."""
+    applied = effective_scale(width, height, scale)
+    for listed, _ in artwork_scales(width, height):
+        if effective_scale(width, height, listed) == applied:
+            return listed
+    return None
+
+
+def _render_upscale(image, scale, fmt):
+    scale = effective_scale(image.width, image.height, scale)
+    return _encode(image.resize((image.width * scale, image.height * scale), Image.NEAREST), fmt)
+
+
+def render_artwork(blob, scale, fmt):
+    """Upscale stored artwork bytes by ``scale`` with nearest-neighbour sampling."""
+    return _render_upscale(pixelstore.open_image(blob).convert('RGBA'), scale, fmt)
+
+
+def artwork_variant_path(root, artwork_id, scale, fmt):
+    return os.path.join(root, 'artworks', str(artwork_id), f"x{scale}.{fmt}")
+
+
+def generate_artwork_variants(root, artwork_id, blob):
+    """Render and write every distinct artwork variant that is not on disk yet."""
+    image = pixelstore.open_image(blob).convert('RGBA')
+    for scale, _ in artwork_scales(image.width, image.height):
+        for fmt in ARTWORK_FORMATS:
+            path = artwork_variant_path(root, artwork_id, scale, fmt)
+            if not os.path.exists(path):
+                data = cache.get(path) or _render_upscale(image, scale, fmt)
+                _write_atomic(path, data)
+
+
+def store_profile_source(root, data):
+    """Save uploaded profile photo bytes under their SHA-256 digest.
+
+    The photo is opened once to reject files Pillow cannot read. Returns the
+    hex digest, which names the photo and all of its variants.
+    """
+    Image.open(BytesIO(data)).verify()
+    digest = hashlib.sha256(data).hexdigest()
+    path = profile_source_path(root, digest)
+    if not os.path.exists(path):
+        _write_atomic(path, data)
+    return digest
+
+
+def render_profile(data, size, fmt):
+    """Crop a profile photo to a square and resample it to ``size`` pixels."""
+    image = ImageOps.exif_transpose(Image.open(BytesIO(data))).convert('RGBA')
+    image = ImageOps.fit(image, (size, size), Image.LANCZOS)
+    return _encode(image, fmt)
+
+
+def profile_source_path(root, digest):
+    return os.path.join(root, 'profiles', 'src', digest)
+
+
+def profile_variant_path(root, digest, size, fmt):
+    return os.path.join(root, 'profiles', f"{digest}_{size}.{fmt}")
+
+
+def generate_profile_variants(root, digest):
+    """Render and write every profile photo variant that is not on disk yet."""
+    with open(profile_source_path(root, digest), 'rb') as f:
+        data = f.read()
+    for size in PROFILE_SIZES:
+        for fmt in PROFILE_FORMATS:
+            path = profile_variant_path(root, digest, size, fmt)
+            if not os.path.exists(path):
+                _write_atomic(path, cache.get(path) or render_profile(data, size, fmt))
+
+
+def schedule(fn, *args):
+    """Run a variant generation job on the background worker pool."""
+    return _executor.submit(fn, *args)
+
+
+def cached_render(path, render, on_miss):
+    """Return variant bytes for ``path`` without touching the disk copy.
+
+    The bytes come from the cache when present; otherwise ``render`` is called,
+    its result cached and ``on_miss`` scheduled to persist the variants.
+    """
+    data = cache.get(path)
+    if data is None:
+        data = render()
+        cache.put(path, data)
+        schedule(*on_miss)
+    return data
@@ -40,7 +40,8 @@ class Artwork(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     archived_by = db.Column(db.String(80), nullable=True)
     archived_date = db.Column(db.DateTime, nullable=True)
-    pixel_data = db.Column(db.LargeBinary, nullable=True)
+    # Deferred so listing queries don't load image bytes; NULL while the bytes are in cold storage.
+    pixel_data = db.deferred(db.Column(db.LargeBinary, nullable=True))
     identifier = db.Column(db.String(50), nullable=True)
     qr_code = db.Column(db.String(120), nullable=True)
     
@@ -50,11 +51,34 @@ class Artwork(db.Model):
         return sum(vote.value for vote in self.votes)
 
 
+class ArtworkPalette(db.Model):
+    artwork_id = db.Column(db.Integer, db.ForeignKey('artwork.id'), primary_key=True)
+    colours = db.Column(db.LargeBinary, nullable=False)    # packed RGB triples, most frequent first
+    counts = db.Column(db.LargeBinary, nullable=False)     # uint32 pixel count for each colour
+    histogram = db.Column(db.LargeBinary, nullable=False)  # float32 coarse colour histogram
+
+    artwork = db.relationship('Artwork', backref=db.backref('palette', uselist=False))
+
+    def dominant_hex(self, limit=5):
+        return ['#' + self.colours[i:i + 3].hex() for i in range(0, min(len(self.colours), limit * 3), 3)]
+
+
+class ColdArtwork(db.Model):
+    # Where an archived artwork's image bytes live in the cold store segment files.
+    artwork_id = db.Column(db.Integer, db.ForeignKey('artwork.id'), primary_key=True)
+    segment = db.Column(db.Integer, nullable=False, index=True)
+    offset = db.Column(db.BigInteger, nullable=False)
+    length = db.Column(db.Integer, nullable=False)
+
+    artwork = db.relationship('Artwork', backref=db.backref('cold_copy', uselist=False, cascade='all, delete-orphan'))
+
+
 class Vote(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     value = db.Column(db.Integer, nullable=False)  # +1 for upvote, -1 for downvote
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     artwork_id = db.Column(db.Integer, db.ForeignKey('artwork.id'), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=True)  # NULL for votes cast before timestamps
     # Ensure each user can vote only once per artwork
     __table_args__ = (db.UniqueConstraint('user_id', 'artwork_id', name='unique_vote'),)
 
@@ -64,9 +88,24 @@ class VoteResetLog(db.Model):
     artwork_id = db.Column(db.Integer, db.ForeignKey('artwork.id'), nullable=False)
     reason = db.Column(db.String(255), nullable=False)
     reset_date = db.Column(db.DateTime, default=datetime.utcnow)
+    votes_removed = db.Column(db.Integer, nullable=True)
     
     artwork = db.relationship('Artwork', backref='reset_logs')
 
+
+class VoteRollup(db.Model):
+    # Vote counts per time bucket, kept up to date as votes are cast and reset.
+    # scope is 'all', 'location' or 'artwork'; key is the location name or artwork id.
+    id = db.Column(db.Integer, primary_key=True)
+    granularity = db.Column(db.String(10), nullable=False)  # 'hour' or 'day'
+    bucket_start = db.Column(db.DateTime, nullable=False)
+    scope = db.Column(db.String(20), nullable=False)
+    key = db.Column(db.String(50), nullable=False)
+    upvotes = db.Column(db.Integer, nullable=False, default=0)
+    downvotes = db.Column(db.Integer, nullable=False, default=0)
+    removed = db.Column(db.Integer, nullable=False, default=0)  # votes deleted by reset_votes
+    __table_args__ = (db.UniqueConstraint('granularity', 'scope', 'key', 'bucket_start', name='unique_rollup_bucket'),)
+
 class TransactionLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     event_type = db.Column(db.String(50), nullable=False)
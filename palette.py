@@ -0,0 +1,249 @@
+"""Colour palette extraction and colour search over artwork pixels.
+
+Palettes are extracted in batches with NumPy: the opaque pixels of every image
+in a batch are packed into ``(image, rgb)`` keys and counted with a single
+``np.unique`` call, so a batch costs one sort rather than one loop per image.
+The extracted palettes are kept in ``ArtworkPalette`` rows and loaded into a
+flat, array-backed ``PaletteIndex`` that answers the gallery colour filters.
+"""
+import threading
+
+import numpy as np
+from PIL import Image
+from sqlalchemy import func
+
+import dbutil
+import pixelstore
+from extensions import db
+from models import Artwork, ArtworkPalette
+
+MAX_COLOURS = 32          # palette entries kept per artwork, most frequent first
+DOMINANT_COLOURS = 5      # leading palette entries shown as the dominant colours
+MAX_SIDE = 128            # larger uploads are nearest-downsampled before counting
+HIST_BITS = 2             # bits per channel in the similarity histogram
+HIST_BINS = 1 << (3 * HIST_BITS)
+DEFAULT_TOLERANCE = 40    # Euclidean RGB distance for "colours near" queries
+SEARCH_LIMIT = 200        # maximum number of artworks returned by a search
+
+
+def load_rgba(blob):
+    """Decode stored image bytes into a ``(H, W, 4)`` uint8 array."""
+    image = pixelstore.open_image(blob)
+    if image.width > MAX_SIDE or image.height > MAX_SIDE:
+        image.thumbnail((MAX_SIDE, MAX_SIDE), Image.NEAREST)
+    return np.asarray(image.convert('RGBA'), dtype=np.uint8)
+
+
+def extract_palettes(blobs):
+    """Extract palettes for a batch of image blobs.
+
+    Returns one ``(colours, counts, histogram)`` tuple per blob, or ``None``
+    for blobs that could not be decoded. ``colours`` is a ``(k, 3)`` uint8
+    array ordered by descending pixel count, ``counts`` the matching uint32
+    counts and ``histogram`` a normalised float32 array of ``HIST_BINS`` bins.
+    """
+    pixels, decoded = [], []
+    for i, blob in enumerate(blobs):
+        try:
+            rgba = load_rgba(blob).reshape(-1, 4)
+        except Exception:
+            continue
+        pixels.append(rgba)
+        decoded.append(i)
+
+    results = [None] * len(blobs)
+    if not decoded:
+        return results
+
+    sizes = np.array([len(p) for p in pixels])
+    owner = np.repeat(np.arange(len(pixels), dtype=np.uint64), sizes)
+    flat = np.concatenate(pixels)
+
+    # Fully transparent pixels are background, not part of the palette.
+    opaque = flat[:, 3] > 0
+    flat, owner = flat[opaque].astype(np.uint64), owner[opaque]
+    keys = (owner << 24) | (flat[:, 0] << 16) | (flat[:, 1] << 8) | flat[:, 2]
+    keys, counts = np.unique(keys, return_counts=True)
+    owners = (keys >> 24).astype(np.int64)
+    rgb = (keys & 0xFFFFFF).astype(np.uint32)
+
+    # Coarse colour histogram per image for "similar palette" queries.
+    shift = 8 - HIST_BITS
+    bins = (((rgb >> (16 + shift)) << (2 * HIST_BITS))
+            | (((rgb >> (8 + shift)) & ((1 << HIST_BITS) - 1)) << HIST_BITS)
+            | ((rgb >> shift) & ((1 << HIST_BITS) - 1)))
+    hist = np.bincount(owners * HIST_BINS + bins, weights=counts,
+                       minlength=len(pixels) * HIST_BINS).reshape(len(pixels), HIST_BINS)
+    totals = hist.sum(axis=1, keepdims=True)
+    hist = (hist / np.maximum(totals, 1)).astype(np.float32)
+
+    # Rank colours within each image by count and keep the top MAX_COLOURS.
+    order = np.lexsort((-counts, owners))
+    owners, rgb, counts = owners[order], rgb[order], counts[order]
+    starts = np.searchsorted(owners, np.arange(len(pixels) + 1))
+    rank = np.arange(len(owners)) - starts[owners]
+    keep = rank < MAX_COLOURS
+    owners, rgb, counts = owners[keep], rgb[keep], counts[keep]
+    starts = np.searchsorted(owners, np.arange(len(pixels) + 1))
+
+    colours = np.stack([(rgb >> 16) & 0xFF, (rgb >> 8) & 0xFF, rgb & 0xFF], axis=1).astype(np.uint8)
+    for j, i in enumerate(decoded):
+        lo, hi = starts[j], starts[j + 1]
+        results[i] = (colours[lo:hi], counts[lo:hi].astype(np.uint32), hist[j])
+    return results
+
+
+def palette_row(artwork_id, extracted):
+    """Build an ``ArtworkPalette`` row from one ``extract_palettes`` result."""
+    colours, counts, histogram = extracted
+    return ArtworkPalette(
+        artwork_id=artwork_id,
+        colours=colours.tobytes(),
+        counts=counts.tobytes(),
+        histogram=histogram.tobytes()
+    )
+
+
+def store_palette(artwork):
+    """Extract and save the palette of a single, already committed artwork."""
+    if not artwork.pixel_data:
+        return None
+    extracted = extract_palettes([artwork.pixel_data])[0]
+    if extracted is None:
+        return None
+    row = palette_row(artwork.id, extracted)
+    db.session.merge(row)
+    db.session.commit()
+    return row
+
+
+def backfill_palettes(batch_size=256):
+    """Extract palettes for every artwork that does not have one yet.
+
+    Artworks are read in primary-key order, ``batch_size`` rows at a time, and
+    the session is cleared after each batch so memory stays bounded however
+    many artworks there are. Returns the number of palettes written.
+    """
+    query = (db.session.query(Artwork.id, Artwork.pixel_data)
+             .outerjoin(ArtworkPalette, ArtworkPalette.artwork_id == Artwork.id)
+             .filter(Artwork.pixel_data.isnot(None), ArtworkPalette.artwork_id.is_(None)))
+    written = 0
+    for rows in dbutil.keyset_batches(query, Artwork.id, batch_size):
+        for (artwork_id, _), extracted in zip(rows, extract_palettes([r.pixel_data for r in rows])):
+            if extracted is not None:
+                db.session.add(palette_row(artwork_id, extracted))
+                written += 1
+        db.session.commit()
+        db.session.expunge_all()
+    return written
+
+
+def parse_hex_colour(value):
+    """Parse ``#RRGGBB`` (or ``RRGGBB``) into an RGB tuple, or return None."""
+    value = (value or '').strip().lstrip('#')
+    if len(value) != 6:
+        return None
+    try:
+        return tuple(int(value[i:i + 2], 16) for i in (0, 2, 4))
+    except ValueError:
+        return None
+
+
+class PaletteIndex:
+    """Flat, array-backed index of every stored artwork palette.
+
+    All palette colours live in one ``(n, 3)`` array with a parallel array of
+    owning artwork positions, and all histograms in one ``(artworks, bins)``
+    array, so each query is a handful of vectorised operations.
+    """
+
+    def __init__(self, artwork_ids, owners, colours, histograms):
+        self.artwork_ids = artwork_ids
+        self.owners = owners
+        self.colours = colours
+        self.histograms = histograms
+        self.positions = {int(a): i for i, a in enumerate(artwork_ids)}
+        # Matches stored_version() while the index holds every stored palette.
+        self.version = (len(artwork_ids), int(artwork_ids[-1]) if len(artwork_ids) else 0)
+
+    @classmethod
+    def build(cls, batch_size=1000):
+        """Load all ``ArtworkPalette`` rows in primary-key ordered batches."""
+        empty = cls(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32),
+                    np.zeros((0, 3), dtype=np.uint8), np.zeros((0, HIST_BINS), dtype=np.float32))
+        return empty.extend(batch_size)
+
+    def extend(self, batch_size=1000):
+        """Return an index that also holds the palettes stored after this one was loaded.
+
+        Only rows with an ``artwork_id`` past the last indexed artwork are
+        read, so picking up a new upload costs one small query rather than a
+        rebuild. Returns ``self`` when there is nothing new.
+        """
+        ids, owners, colours, histograms = [], [self.owners], [self.colours], [self.histograms]
+        query = db.session.query(ArtworkPalette.artwork_id, ArtworkPalette.colours, ArtworkPalette.histogram)
+        for rows in dbutil.keyset_batches(query, ArtworkPalette.artwork_id, batch_size, after=self.version[1]):
+            for artwork_id, colour_bytes, hist_bytes in rows:
+                palette = np.frombuffer(colour_bytes, dtype=np.uint8).reshape(-1, 3)
+                owners.append(np.full(len(palette), len(self.artwork_ids) + len(ids), dtype=np.int32))
+                colours.append(palette)
+                histograms.append(np.frombuffer(hist_bytes, dtype=np.float32).reshape(1, HIST_BINS))
+                ids.append(artwork_id)
+
+        if not ids:
+            return self
+        return type(self)(np.concatenate([self.artwork_ids, np.array(ids, dtype=np.int64)]),
+                          np.concatenate(owners), np.concatenate(colours), np.vstack(histograms))
+
+    def near_colour(self, rgb, tolerance=DEFAULT_TOLERANCE, limit=SEARCH_LIMIT):
+        """Artwork ids containing a colour within ``tolerance``, closest first."""
+        if not len(self.artwork_ids):
+            return []
+        diff = self.colours.astype(np.int32) - np.array(rgb, dtype=np.int32)
+        dist = np.einsum('ij,ij->i', diff, diff)
+        best = np.full(len(self.artwork_ids), np.iinfo(np.int32).max, dtype=np.int64)
+        np.minimum.at(best, self.owners, dist)
+        matches = np.flatnonzero(best <= tolerance * tolerance)
+        matches = matches[np.argsort(best[matches], kind='stable')][:limit]
+        return self.artwork_ids[matches].tolist()
+
+    def similar(self, artwork_id, limit=SEARCH_LIMIT):
+        """Artwork ids ranked by histogram intersection with ``artwork_id``."""
+        position = self.positions.get(artwork_id)
+        if position is None:
+            return []
+        scores = np.minimum(self.histograms, self.histograms[position]).sum(axis=1)
+        scores[position] = -1
+        ranked = np.argsort(-scores, kind='stable')[:limit]
+        return self.artwork_ids[ranked[scores[ranked] > 0]].tolist()
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def stored_version():
+    """``(count, max artwork_id)`` of the stored palettes, compared against ``PaletteIndex.version``."""
+    count, last_id = db.session.query(func.count(ArtworkPalette.artwork_id),
+                                      func.max(ArtworkPalette.artwork_id)).one()
+    return count, last_id or 0
+
+
+def get_index():
+    """Return the process-wide palette index, bringing it up to date first.
+
+    Every query checks the stored palettes' version, so palettes written by
+    other worker processes are picked up too. New uploads are appended with
+    ``extend()``; anything else (backfilled older artworks, deleted rows)
+    leaves the versions disagreeing and triggers a full rebuild.
+    """
+    global _index
+    version = stored_version()
+    with _index_lock:
+        if _index is None:
+            _index = PaletteIndex.build()
+        elif _index.version != version:
+            _index = _index.extend()
+            if _index.version != version:
+                _index = PaletteIndex.build()
+        return _index
@@ -0,0 +1,178 @@
+"""Compact raw-pixel storage for artworks and batch operations over it.
+
+An artwork can be stored in the ``VPX1`` format instead of a PNG: a 10-byte
+header followed by a zlib stream holding an RGBA palette and one palette index
+per pixel (or the raw RGBA pixels when an image has more than 256 colours)::
+
+    magic  b'VPX1'
+    width  uint16, little-endian
+    height uint16
+    colours uint16   palette length, 0 for raw RGBA
+
+Decoding is a ``zlib.decompress`` plus one NumPy fancy-index, with no PNG
+filtering to undo. ``pack()`` decodes many artworks once into a flat file of
+fixed-shape ``(SIDE, SIDE, 4)`` records that ``open_batch()`` memory-maps as a
+single array, and the batch helpers below work on that array in chunks.
+"""
+import struct
+import zlib
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+MAGIC = b'VPX1'
+HEADER = struct.Struct('<4sHHH')
+SIDE = 64                # canonical artwork size
+CHUNK = 1024             # artworks processed at a time by the batch helpers
+COMPRESSION_LEVEL = 9
+
+
+def is_vpx(blob):
+    return blob is not None and blob[:4] == MAGIC
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+SIZE_HEADER_BYTES = 24   # enough of a PNG or VPX1 blob for image_size()
+
+
+def image_size(header):
+    """``(width, height)`` from the first ``SIZE_HEADER_BYTES`` of stored artwork bytes.
+
+    Reads the ``VPX1`` header or the PNG ``IHDR`` chunk without decoding any
+    pixels. Returns None for other formats or truncated input.
+    """
+    if header is None:
+        return None
+    header = bytes(header)
+    if header[:4] == MAGIC and len(header) >= HEADER.size:
+        return HEADER.unpack_from(header)[1:3]
+    if header[:8] == PNG_SIGNATURE and header[12:16] == b'IHDR' and len(header) >= 24:
+        return struct.unpack('>II', header[16:24])
+    return None
+
+
+def encode(rgba):
+    """Encode a ``(H, W, 4)`` uint8 array as ``VPX1`` bytes."""
+    rgba = np.ascontiguousarray(rgba, dtype=np.uint8)
+    height, width = rgba.shape[:2]
+    colours, indices = np.unique(rgba.view(np.uint32).ravel(), return_inverse=True)
+    if len(colours) <= 256:
+        payload = colours.tobytes() + indices.astype(np.uint8).tobytes()
+        count = len(colours)
+    else:
+        payload, count = rgba.tobytes(), 0
+    return HEADER.pack(MAGIC, width, height, count) + zlib.compress(payload, COMPRESSION_LEVEL)
+
+
+def decode(blob):
+    """Decode ``VPX1`` bytes into a ``(H, W, 4)`` uint8 array."""
+    magic, width, height, count = HEADER.unpack_from(blob)
+    if magic != MAGIC:
+        raise ValueError("not a VPX1 artwork")
+    payload = zlib.decompress(blob[HEADER.size:])
+    if count == 0:
+        return np.frombuffer(payload, dtype=np.uint8).reshape(height, width, 4)
+    colours = np.frombuffer(payload, dtype=np.uint32, count=count)
+    indices = np.frombuffer(payload, dtype=np.uint8, offset=count * 4)
+    return colours[indices].view(np.uint8).reshape(height, width, 4)
+
+
+def open_image(blob):
+    """Open stored artwork bytes, ``VPX1`` or any PIL format, as a PIL image."""
+    if is_vpx(blob):
+        return Image.fromarray(decode(blob), 'RGBA')
+    return Image.open(BytesIO(blob))
+
+
+def load_rgba(blob):
+    """Stored artwork bytes as a ``(H, W, 4)`` uint8 array."""
+    if is_vpx(blob):
+        return decode(blob)
+    return np.asarray(Image.open(BytesIO(blob)).convert('RGBA'), dtype=np.uint8)
+
+
+def to_png(blob):
+    """PNG bytes for stored artwork bytes; PNG input is returned unchanged."""
+    if not is_vpx(blob):
+        return blob
+    out = BytesIO()
+    Image.fromarray(decode(blob), 'RGBA').save(out, format='PNG')
+    return out.getvalue()
+
+
+def pack(path, items):
+    """Decode ``(artwork_id, blob)`` pairs into a memory-mappable batch file.
+
+    Pixels go to ``path`` as consecutive ``SIDE x SIDE`` RGBA records and the
+    artwork ids to ``path + '.ids.npy'``. Artworks that are not the canonical
+    size, or cannot be decoded, are skipped. Returns the number packed.
+    """
+    ids = []
+    with open(path, 'wb') as out:
+        for artwork_id, blob in items:
+            try:
+                rgba = load_rgba(blob)
+            except Exception:
+                continue
+            if rgba.shape != (SIDE, SIDE, 4):
+                continue
+            out.write(rgba.tobytes())
+            ids.append(artwork_id)
+    np.save(path + '.ids.npy', np.array(ids, dtype=np.int64))
+    return len(ids)
+
+
+def open_batch(path):
+    """Memory-map a file written by ``pack()`` as ``(ids, (N, SIDE, SIDE, 4))``."""
+    ids = np.load(path + '.ids.npy')
+    if not len(ids):
+        return ids, np.zeros((0, SIDE, SIDE, 4), dtype=np.uint8)
+    pixels = np.memmap(path, dtype=np.uint8, mode='r', shape=(len(ids), SIDE, SIDE, 4))
+    return ids, pixels
+
+
+def _chunks(batch):
+    for start in range(0, len(batch), CHUNK):
+        yield np.asarray(batch[start:start + CHUNK])
+
+
+def thumbnails(batch, factor=4):
+    """Box-filtered ``SIDE // factor`` thumbnails for every artwork in ``batch``."""
+    side = SIDE // factor
+    out = np.empty((len(batch), side, side, 4), dtype=np.uint8)
+    for start, chunk in zip(range(0, len(batch), CHUNK), _chunks(batch)):
+        blocks = chunk.reshape(len(chunk), side, factor, side, factor, 4)
+        out[start:start + len(chunk)] = blocks.mean(axis=(2, 4), dtype=np.float32).round().astype(np.uint8)
+    return out
+
+
+def average_hashes(batch):
+    """64-bit average hash per artwork, for spotting duplicates and near-copies."""
+    weights = 1 << np.arange(63, -1, -1, dtype=np.uint64)
+    out = np.empty(len(batch), dtype=np.uint64)
+    for start, chunk in zip(range(0, len(batch), CHUNK), _chunks(batch)):
+        grey = chunk[..., :3].astype(np.float32) @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+        grey = grey.reshape(len(chunk), 8, SIDE // 8, 8, SIDE // 8).mean(axis=(2, 4)).reshape(len(chunk), 64)
+        bits = grey > grey.mean(axis=1, keepdims=True)
+        out[start:start + len(chunk)] = (bits * weights).sum(axis=1, dtype=np.uint64)
+    return out
+
+
+def palette_stats(batch):
+    """Distinct colour count and transparent-pixel fraction per artwork."""
+    colours = np.empty(len(batch), dtype=np.int32)
+    transparent = np.empty(len(batch), dtype=np.float32)
+    for start, chunk in zip(range(0, len(batch), CHUNK), _chunks(batch)):
+        flat = np.sort(np.ascontiguousarray(chunk).view(np.uint32).reshape(len(chunk), -1), axis=1)
+        colours[start:start + len(chunk)] = (np.diff(flat, axis=1) != 0).sum(axis=1) + 1
+        transparent[start:start + len(chunk)] = (chunk[..., 3] == 0).mean(axis=(1, 2))
+    return colours, transparent
+
+
+def atlas(batch, columns=16):
+    """Tile every artwork in ``batch`` into one ``(rows * SIDE, columns * SIDE, 4)`` sheet."""
+    rows = -(-len(batch) // columns)
+    tiles = np.zeros((rows * columns, SIDE, SIDE, 4), dtype=np.uint8)
+    tiles[:len(batch)] = batch
+    return tiles.reshape(rows, columns, SIDE, SIDE, 4).transpose(0, 2, 1, 3, 4).reshape(rows * SIDE, columns * SIDE, 4)